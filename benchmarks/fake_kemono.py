@@ -0,0 +1,113 @@
+# Local stand-in for the Kemono endpoints used by the bot, for offline benchmarks
+import asyncio
+import hashlib
+import json
+import random
+import socket
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris. ")
+
+# Fake Kemono API and data host serving one generated creator.
+# Every request waits `latency` seconds; `requests` counts requests per endpoint. Feed pages carry an ETag and
+# conditional requests for an unchanged page are answered with 304 (counted as `feed_304`).
+class FakeKemono:
+    def __init__(self, posts=500, page_size=50, post_bytes=20000, images_per_post=0, image_bytes=30000,
+                 latency=0.05, service='patreon', creator_id='1000', seed=0):
+        self.page_size = page_size
+        self.latency = latency
+        self.service = service
+        self.creator_id = creator_id
+        self.requests = Counter()
+        self.runner = None
+        self.port = None
+        self.post_bytes = post_bytes
+        self.images_per_post = images_per_post
+        self.seed = seed
+        rng = random.Random(seed)
+        self.image_blob = rng.randbytes(image_bytes)
+        self.posts = []
+        self.by_id = {}
+        for _ in range(posts):
+            self.publish()
+
+    # Add a new post at the top of the feed and return it
+    def publish(self):
+        i = len(self.posts)
+        images = "".join(
+            f'<p><img src="/{digest[:2]}/{digest[2:4]}/{digest}.jpg"></p>'
+            for digest in (hashlib.sha256(f"{self.seed}-{i}-{n}".encode()).hexdigest() for n in range(self.images_per_post))
+        )
+        text = (LOREM * (self.post_bytes // len(LOREM) + 1))[:self.post_bytes]
+        post = {
+            'id': str(100000 + i),
+            'user': self.creator_id,
+            'service': self.service,
+            'title': f"Chapter {i + 1}",
+            'published': (datetime(2024, 1, 1) + timedelta(hours=i)).isoformat(),
+            'edited': None,
+            'content': f"<p>{text}</p>{images}",
+        }
+        self.posts.insert(0, post)
+        self.by_id[post['id']] = post
+        return post
+
+    @property
+    def feed_url(self):
+        return f"http://127.0.0.1:{self.port}/api/v1/{self.service}/user/{self.creator_id}"
+
+    # Images are served from a different host name so they get their own per-host limits, like n4.kemono.su
+    @property
+    def data_url(self):
+        return f"http://localhost:{self.port}/data"
+
+    async def _delay(self, kind):
+        self.requests[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def feed(self, request):
+        offset = int(request.query.get('o', 0))
+        body = json.dumps(self.posts[offset:offset + self.page_size])
+        etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:16]}"'
+        if request.headers.get('If-None-Match') == etag:
+            await self._delay('feed_304')
+            return web.Response(status=304, headers={'ETag': etag})
+        await self._delay('feed')
+        return web.Response(text=body, content_type='application/json', headers={'ETag': etag})
+
+    async def profile(self, request):
+        await self._delay('profile')
+        return web.json_response({'id': self.creator_id, 'service': self.service, 'name': 'Benchmark Creator'})
+
+    async def post(self, request):
+        await self._delay('post')
+        post = self.by_id.get(request.match_info['post_id'])
+        if post is None:
+            raise web.HTTPNotFound()
+        return web.json_response({'post': post})
+
+    async def data(self, request):
+        await self._delay('data')
+        return web.Response(body=self.image_blob, content_type='image/jpeg')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/v1/{service}/user/{creator_id}', self.feed)
+        app.router.add_get('/api/v1/{service}/user/{creator_id}/profile', self.profile)
+        app.router.add_get('/api/v1/{service}/user/{creator_id}/post/{post_id}', self.post)
+        app.router.add_get('/data/{path:.*}', self.data)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        await web.SockSite(self.runner, sock).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,152 @@
+# Offline end-to-end benchmark of the fetch and EPUB building code against a local fake Kemono server.
+#
+#   python benchmarks/run.py
+#   python benchmarks/run.py --scenarios images-500-cold --iterations 5 --latency 0.1
+#
+# Each scenario runs the /fetch flow without Discord (fetch_chapters + create_epub) and reports latency
+# percentiles, throughput, peak traced memory and the number of requests the fake server received.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fake_kemono import FakeKemono
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    f"{kind}-{chapters}-{cache}": {'chapters': chapters, 'images_per_post': images, 'cache': cache}
+    for kind, images in (('text', 0), ('images', 3))
+    for chapters in (10, 500)
+    for cache in ('cold', 'warm')
+}
+
+sys.path.insert(0, REPO_DIR)
+import kemono
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+# Point the core at fresh caches and a new HTTP client
+def reset_state(workdir, run_id, args):
+    kemono.post_index = kemono.PostIndex(os.path.join(workdir, f"posts-{run_id}.db"))
+    kemono.image_cache = kemono.ImageCache(os.path.join(workdir, f"images-{run_id}"))
+    if args.production_limits:
+        host_limits = {'127.0.0.1': kemono.HTTP_HOST_LIMITS['kemono.su'], 'localhost': kemono.HTTP_HOST_LIMITS['n4.kemono.su']}
+        host_rates = {'127.0.0.1': kemono.HTTP_HOST_RATES['kemono.su'], 'localhost': kemono.HTTP_HOST_RATES['n4.kemono.su']}
+    else:
+        host_limits = {'127.0.0.1': 64, 'localhost': 64}
+        host_rates = {'127.0.0.1': 1e6, 'localhost': 1e6}
+    kemono.http_client = kemono.HttpClient(host_limits=host_limits, host_rates=host_rates)
+
+async def run_flow(server, chapters):
+    start = time.perf_counter()
+    posts = await kemono.fetch_chapters(server.feed_url, chapters)
+    fetched = time.perf_counter()
+    volumes = await kemono.create_epub(posts, 'Benchmark', 'Benchmark', server.feed_url)
+    built = time.perf_counter()
+    return {'fetch': fetched - start, 'build': built - fetched, 'total': built - start,
+            'chapters': len(posts), 'bytes': sum(map(len, volumes)), 'volumes': len(volumes)}
+
+async def run_scenario(workdir, name, scenario, args):
+    images_per_post = scenario['images_per_post']
+    if images_per_post and args.images_per_post is not None:
+        images_per_post = args.images_per_post
+    server = FakeKemono(posts=max(scenario['chapters'], args.posts), page_size=args.page_size,
+                        post_bytes=args.post_bytes, images_per_post=images_per_post,
+                        image_bytes=args.image_bytes, latency=args.latency)
+    await server.start()
+    kemono.KEMONO_URL = f"http://127.0.0.1:{server.port}"
+    kemono.KEMONO_DATA_URL = server.data_url
+    warm = scenario['cache'] == 'warm'
+    samples = []
+    peak_memory = 0
+    requests = {}
+    try:
+        if warm:
+            reset_state(workdir, f"{name}-warm", args)
+            await run_flow(server, scenario['chapters'])
+        wall_start = time.perf_counter()
+        for iteration in range(args.iterations):
+            if not warm:
+                await kemono.http_client.close()
+                reset_state(workdir, f"{name}-{iteration}", args)
+            server.requests.clear()
+            if args.memory:
+                tracemalloc.start()
+            flows = await asyncio.gather(*(run_flow(server, scenario['chapters']) for _ in range(args.concurrency)))
+            if args.memory:
+                peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            samples.extend(flows)
+            for kind, count in server.requests.items():
+                requests[kind] = requests.get(kind, 0) + count
+        wall = time.perf_counter() - wall_start
+    finally:
+        await kemono.http_client.close()
+        await server.stop()
+
+    totals = [sample['total'] for sample in samples]
+    return {
+        'scenario': name,
+        'flows': len(samples),
+        'p50_ms': percentile(totals, 50) * 1000,
+        'p90_ms': percentile(totals, 90) * 1000,
+        'p99_ms': percentile(totals, 99) * 1000,
+        'fetch_p50_ms': percentile([sample['fetch'] for sample in samples], 50) * 1000,
+        'build_p50_ms': percentile([sample['build'] for sample in samples], 50) * 1000,
+        'chapters_per_s': sum(sample['chapters'] for sample in samples) / wall,
+        'mb_per_s': sum(sample['bytes'] for sample in samples) / wall / 1024 ** 2,
+        'volumes': samples[-1]['volumes'],
+        'peak_mb': peak_memory / 1024 ** 2 if args.memory else None,
+        'requests_per_flow': {kind: count / len(samples) for kind, count in sorted(requests.items())},
+    }
+
+def print_table(results):
+    header = f"{'scenario':<20} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'fetch':>8} {'build':>8} {'ch/s':>8} {'MB/s':>7} {'vols':>4} {'peak MB':>8}  requests/flow"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+        requests = ', '.join(f"{kind}={count:g}" for kind, count in r['requests_per_flow'].items())
+        print(f"{r['scenario']:<20} {r['p50_ms']:>9.1f} {r['p90_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['fetch_p50_ms']:>8.1f} "
+              f"{r['build_p50_ms']:>8.1f} {r['chapters_per_s']:>8.1f} {r['mb_per_s']:>7.2f} {r['volumes']:>4} {peak:>8}  {requests}")
+
+# Caches and databases live in a scratch directory that is removed when the run ends
+async def main(args):
+    cwd = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory(prefix='kemono-bench-') as workdir:
+        os.chdir(workdir)
+        try:
+            for name in args.scenarios:
+                results.append(await run_scenario(workdir, name, SCENARIOS[name], args))
+                print(f"finished {name}", file=sys.stderr)
+        finally:
+            await kemono.shutdown()
+            os.chdir(cwd)
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark chapter fetching and EPUB building against a local fake Kemono")
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=1, help="simultaneous flows per iteration, as if several users ran /fetch")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every fake Kemono response")
+    parser.add_argument('--posts', type=int, default=500, help="posts the fake creator has")
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--post-bytes', type=int, default=20000, help="text size of each post")
+    parser.add_argument('--image-bytes', type=int, default=30000, help="size of each image")
+    parser.add_argument('--images-per-post', type=int, help="images in each post of the images-* scenarios (default 3)")
+    parser.add_argument('--production-limits', action='store_true', help="apply kemono.su/n4.kemono.su connection and rate limits")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip tracemalloc peak memory tracking")
+    parser.add_argument('--json', help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
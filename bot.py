@@ -2,29 +2,32 @@ import discord
 from discord import app_commands
 import asyncio
 import logging
-import aiohttp
 import os
 import json
-from ebooklib import epub
-import re
+import io
+import time
+from kemono import (
+    CREATORS_FILE, WATCH_MAX_FOLLOWS_PER_USER, creator_registry, metrics, start_metrics_server, job_scheduler,
+    QueueFullError, EpubCache, epub_cache, subscriptions, CreatorWatcher, shutdown, fix_link, parse_feed_url,
+    get_creator_name, fetch_chapters, fetch_chapter_summaries, load_chapters, create_epub, generate_filename,
+)
 
 # Custom filter to exclude "RESUMED" messages from discord.gateway
 class GatewayFilter(logging.Filter):
     def filter(self, record):
         return not (record.name == "discord.gateway" and "RESUMED" in record.msg)
 
-handler = logging.FileHandler('bot.log')
-handler.setLevel(logging.INFO)
-handler.addFilter(GatewayFilter())
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.addHandler(handler)
+# Log to bot.log
+def setup_logging():
+    handler = logging.FileHandler('bot.log')
+    handler.setLevel(logging.INFO)
+    handler.addFilter(GatewayFilter())
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
 
-# Constants
-CREATORS_FILE = 'creators.txt'
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
 
 # Load configuration from setup
 def setup_bot():
@@ -47,31 +50,44 @@ def setup_bot():
     
     return config['BOT_TOKEN'], config['GUILD_ID'], config['FETCH_CHANNEL_ID'], config['ALLOWED_ROLES'], config['ADMIN_ROLES']
 
-# Load creators from txt file
-def load_creators():
-    creators = {}
-    try:
-        with open(CREATORS_FILE, 'r') as f:
-            for line in f:
-                if '=' in line:
-                    name, url = map(str.strip, line.split('=', 1))
-                    creators[name] = url
-    except FileNotFoundError:
-        logging.warning(f"{CREATORS_FILE} not found. Returning empty dict.")
-    return creators
-
-# Save creators to txt file
-def save_creators(creators):
-    with open(CREATORS_FILE, 'w') as f:
-        for name, url in creators.items():
-            f.write(f"{name} = {url}\n")
-
-# Bot initialization
-bot_token, guild_id, fetch_channel_id, allowed_roles, admin_roles = setup_bot()
-intents = discord.Intents.default()
-intents.message_content = True
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
+# Discord client owning the shared HTTP client, job scheduler, image pool, creator watcher and metrics listener
+# for its whole lifetime
+class FetchBot(discord.Client):
+    metrics_runner = None
+
+    async def setup_hook(self):
+        try:
+            self.metrics_runner = await start_metrics_server()
+        except OSError as e:
+            logging.error(f"Failed to start metrics listener: {e}")
+        try:
+            await creator_watcher.start()
+        except Exception as e:
+            logging.error(f"Failed to start creator watcher: {e}")
+
+    async def close(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await creator_watcher.close()
+        for task in list(follower_deliveries):
+            task.cancel()
+        await job_scheduler.close()
+        await shutdown()
+        await super().close()
+
+    async def on_disconnect(self):
+        logging.info("Bot disconnected from Discord Gateway. Reconnect attempts may follow...")
+
+    async def on_ready(self):
+        await tree.sync(guild=discord.Object(id=guild_id))
+        logging.info(f'{self.user} connected and commands synced to guild {guild_id}!')
+
+# Configuration and Discord client, set up by main(). Nothing is loaded at import time because the image
+# transcoding workers (spawn start method) re-import this script in every worker process.
+bot_token = guild_id = fetch_channel_id = None
+allowed_roles = admin_roles = []
+client = None
+tree = None
 
 # Paginated chapter selection view
 class ChapterSelectView(discord.ui.View):
@@ -87,6 +103,7 @@ class ChapterSelectView(discord.ui.View):
         self.kemono_page_size = 50
         self.kemono_pages_fetched = 1
         self.selected_chapters = set()
+        self.prefetch_task = None
         self.update_select()
 
     def update_select(self):
@@ -105,7 +122,7 @@ class ChapterSelectView(discord.ui.View):
             max_values=len(page_chapters),
             options=[
                 discord.SelectOption(
-                    label=f"#{i+1} {c.get('title', 'Untitled')[:75]}{'...' if len(c.get('title', 'Untitled')) > 75 else ''}",
+                    label=f"#{i+1} {c.title[:75]}{'...' if len(c.title) > 75 else ''}",
                     value=str(i),
                     default=i in self.selected_chapters
                 )
@@ -133,19 +150,35 @@ class ChapterSelectView(discord.ui.View):
         download_button.callback = self.on_download
         self.add_item(download_button)
 
+        # Load the next Kemono page in the background once the last loaded page is shown
+        if end_idx >= len(self.chapters) and self.can_fetch_more() and not self.prefetch_running():
+            self.prefetch_task = asyncio.create_task(self.load_next_kemono_page())
+
     def can_fetch_more(self):
         return len(self.chapters) == self.kemono_pages_fetched * self.kemono_page_size
 
+    def prefetch_running(self):
+        return self.prefetch_task is not None and not self.prefetch_task.done()
+
+    async def load_next_kemono_page(self):
+        offset = self.kemono_pages_fetched * self.kemono_page_size
+        try:
+            new_chapters = await fetch_chapter_summaries(self.url, self.kemono_page_size, offset=offset)
+        except Exception as e:
+            logging.error(f"Failed to load more chapters: {e}")
+            return False
+        if new_chapters:
+            self.chapters.extend(new_chapters)
+            self.kemono_pages_fetched += 1
+            self.pages = (len(self.chapters) + self.per_page - 1) // self.per_page
+        return bool(new_chapters)
+
     async def fetch_more_chapters(self):
         required_kemono_page = (self.page * self.per_page) // self.kemono_page_size + 1
         if required_kemono_page > self.kemono_pages_fetched:
-            offset = self.kemono_pages_fetched * self.kemono_page_size
-            new_chapters = await fetch_chapters(self.url, self.kemono_page_size, offset=offset)
-            if new_chapters:
-                self.chapters.extend(new_chapters)
-                self.kemono_pages_fetched += 1
-                self.pages = (len(self.chapters) + self.per_page - 1) // self.per_page
-            return bool(new_chapters)
+            if not self.prefetch_running():
+                self.prefetch_task = asyncio.create_task(self.load_next_kemono_page())
+            return await self.prefetch_task
         return False
 
     async def on_select(self, interaction: discord.Interaction):
@@ -186,57 +219,49 @@ class ChapterSelectView(discord.ui.View):
         if not self.selected_chapters:
             await interaction.response.send_message("No chapters selected!", ephemeral=True, delete_after=5)
             return
-        chapters_to_fetch = [self.chapters[i] for i in sorted(self.selected_chapters)]
-        filename = generate_filename(chapters_to_fetch)
-        epub_file = await create_epub(chapters_to_fetch, self.creator_name, self.creator_name, self.url, filename)
-        with open(epub_file, 'rb') as file:
-            await interaction.user.send(
-                f"Fetched from **[{self.creator_name}](<{self.url.replace('/api/v1/', '/')}>)**.",
-                file=discord.File(file, f"{filename}.epub")
-            )
-        logging.info(f"EPUB '{filename}.epub' sent to {interaction.user} for creator '{self.creator_name}'")
-        await interaction.response.send_message("EPUB sent to your DMs!", ephemeral=True)
-        os.remove(epub_file)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            chapters_to_fetch = await load_chapters(self.url, [self.chapters[i] for i in sorted(self.selected_chapters)])
+            await send_epub(interaction, chapters_to_fetch, self.creator_name, self.url)
+            await interaction.edit_original_response(content="EPUB sent to your DMs!")
+        except Exception as e:
+            logging.error(f"Download error: {e}")
+            await interaction.edit_original_response(content=f"Error: {str(e)}")
 
 # Fetch command
-@tree.command(name="fetch", description="Fetch chapters from a Kemono creator", guild=discord.Object(id=guild_id))
+@app_commands.command(name="fetch", description="Fetch chapters from a Kemono creator")
 @app_commands.describe(
     creator="Creator name from list or a URL",
     num_chapters="Number of chapters to fetch (optional)",
     skip_chapters="Comma-separated list of chapter numbers to skip (optional)"
 )
-async def fetch(interaction: discord.Interaction, creator: str, num_chapters: int = None, skip_chapters: str = None):
-    if not await check_role(interaction):
-        return
-    if str(interaction.channel_id) != fetch_channel_id:
-        await interaction.response.send_message(f"This command can only be used in <#{fetch_channel_id}>.", ephemeral=True, delete_after=10)
+async def fetch(interaction: discord.Interaction, creator: str, num_chapters: app_commands.Range[int, 1, None] = None, skip_chapters: str = None):
+    if not await check_role(interaction) or not await check_channel(interaction):
         return
 
     logging.info(f"Fetch command used by {interaction.user} for creator '{creator}' with num_chapters={num_chapters}, skip_chapters={skip_chapters}")
     await interaction.response.defer(ephemeral=True)
-    creators = load_creators()
+    url = creator_registry.get(creator)
 
-    if creator in creators:
-        url = creators[creator]
+    if url is not None:
         creator_name = creator
     else:
         url = creator
         creator_name = None
 
     try:
-        fixed_url = await fix_link(url)
+        with metrics.timer('resolve'):
+            fixed_url = await fix_link(url)
         if not fixed_url:
             message = await interaction.followup.send("Invalid URL or creator name not found.", ephemeral=True)
             await message.delete(delay=10)
             return
 
         if not creator_name:
-            parts = fixed_url.split('/')
-            if len(parts) >= 8 and parts[3] == 'api' and parts[4] == 'v1':
-                service, creator_id = parts[5], parts[7]
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f"https://kemono.su/api/v1/{service}/user/{creator_id}/profile") as resp:
-                        creator_name = (await resp.json()).get('name', 'Unknown') if resp.status == 200 else "Unknown"
+            creator_key = parse_feed_url(fixed_url)
+            if creator_key:
+                service, creator_id = creator_key
+                creator_name = await get_creator_name(service, creator_id)
             else:
                 message = await interaction.followup.send("Invalid URL format.", ephemeral=True)
                 await message.delete(delay=10)
@@ -253,19 +278,11 @@ async def fetch(interaction: discord.Interaction, creator: str, num_chapters: in
                 chapters_to_process = [c for i, c in enumerate(all_chapters, 1) if i not in skip_set][:num_chapters]
             else:
                 chapters_to_process = all_chapters
-            filename = generate_filename(chapters_to_process)
-            epub_file = await create_epub(chapters_to_process, creator_name, creator_name, fixed_url, filename)
-            with open(epub_file, 'rb') as file:
-                await interaction.user.send(
-                    f"Fetched from **[{creator_name}](<{fixed_url.replace('/api/v1/', '/')}>)**.",
-                    file=discord.File(file, f"{filename}.epub")
-                )
-            logging.info(f"EPUB '{filename}.epub' sent to {interaction.user} for creator '{creator_name}'")
-            message = await interaction.followup.send("EPUB sent to your DMs!", ephemeral=True)
+            await send_epub(interaction, chapters_to_process, creator_name, fixed_url)
+            message = await interaction.edit_original_response(content="EPUB sent to your DMs!")
             await message.delete(delay=10)
-            os.remove(epub_file)
         else:
-            initial_chapters = await fetch_chapters(fixed_url, 50)
+            initial_chapters = await fetch_chapter_summaries(fixed_url, 50)
             if not initial_chapters:
                 message = await interaction.followup.send("No chapters found.", ephemeral=True)
                 await message.delete(delay=10)
@@ -281,28 +298,12 @@ async def fetch(interaction: discord.Interaction, creator: str, num_chapters: in
 
 # Autocomplete for creator parameter
 async def creator_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-    creators = load_creators()
-    # Get all matching creators with their match positions
-    matches_with_positions = [
-        (name, name.lower().find(current.lower()))
-        for name in creators.keys()
-        if current.lower() in name.lower()
-    ]
-    # Sort by position first, then alphabetically within each position group
-    sorted_matches = sorted(
-        matches_with_positions,
-        key=lambda x: (x[1], x[0].lower())
-    )
-    # Return up to 25 choices
-    return [
-        app_commands.Choice(name=name, value=name)
-        for name, _ in sorted_matches
-    ][:25]
+    return [app_commands.Choice(name=name, value=name) for name in creator_registry.search(current, 25)]
 
 fetch.autocomplete('creator')(creator_autocomplete)
 
 # Add creator command (admin only)
-@tree.command(name="add_creator", description="Add a creator to the list (Admin only)", guild=discord.Object(id=guild_id))
+@app_commands.command(name="add_creator", description="Add a creator to the list (Admin only)")
 @app_commands.describe(name="Creator name", url="Kemono URL")
 async def add_creator(interaction: discord.Interaction, name: str, url: str):
     if not await check_role(interaction, require_admin=True):
@@ -312,117 +313,201 @@ async def add_creator(interaction: discord.Interaction, name: str, url: str):
         await interaction.response.send_message("URL must be a valid Kemono URL.", ephemeral=True, delete_after=10)
         return
 
-    creators = load_creators()
-    creators[name] = url
-    save_creators(creators)
+    creator_registry.add(name, url)
     await interaction.response.send_message(f"Added {name} with URL {url}", ephemeral=True, delete_after=10)
 
 # Remove creator command (admin only)
-@tree.command(name="remove_creator", description="Remove a creator from the list (Admin only)", guild=discord.Object(id=guild_id))
+@app_commands.command(name="remove_creator", description="Remove a creator from the list (Admin only)")
 @app_commands.describe(name="Creator name")
 async def remove_creator(interaction: discord.Interaction, name: str):
     if not await check_role(interaction, require_admin=True):
         return
 
-    creators = load_creators()
-    if name in creators:
-        del creators[name]
-        save_creators(creators)
+    if creator_registry.remove(name):
         await interaction.response.send_message(f"Removed {name}", ephemeral=True, delete_after=10)
     else:
         await interaction.response.send_message(f"{name} not found.", ephemeral=True, delete_after=10)
 
-# Fix link to API format
-async def fix_link(link):
-    if not link or not isinstance(link, str):
-        return None
-    link = link.strip()
-    if "patreon.com" in link.lower():
-        user_id = await get_patreon_id(link)
-        return f"https://kemono.su/api/v1/patreon/user/{user_id}" if user_id else None
-    if not link.startswith("http"):
-        link = f"https://{link.lstrip('/')}"
-    if link.startswith("https://kemono.su/") and not link.startswith("https://kemono.su/api/v1/"):
-        link = link.replace("https://kemono.su/", "https://kemono.su/api/v1/")
-    return link if "kemono.su/api/v1/" in link else None
-
-# Get Patreon ID from URL
-async def get_patreon_id(url):
-    async with aiohttp.ClientSession() as session:
+# Stats command (admin only)
+@app_commands.command(name="stats", description="Show fetch timings and cache statistics (Admin only)")
+async def stats(interaction: discord.Interaction):
+    if not await check_role(interaction, require_admin=True):
+        return
+
+    lines = [f"{'stage':<12} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}"]
+    for stage, (samples, count, total) in sorted(metrics.timings.items()):
+        p50, p90, p99 = metrics.percentiles(stage)
+        lines.append(f"{stage:<12} {count:>6} {p50 * 1000:>8.0f} {p90 * 1000:>8.0f} {p99 * 1000:>8.0f}")
+    lines.append("")
+    for cache in ('resolve', 'feed', 'image', 'epub'):
+        ratio = metrics.hit_ratio(cache)
+        lines.append(f"{cache} cache hit ratio: {'-' if ratio is None else f'{ratio:.0%}'}")
+    for name in ('http_bytes', 'image_bytes', 'epub_bytes', 'upload_bytes'):
+        total = sum(value for (counter, _), value in metrics.counters.items() if counter == name)
+        lines.append(f"{name.replace('_', ' ')}: {total / 1024 ** 2:.1f} MB")
+    retries = sum(value for (counter, _), value in metrics.counters.items() if counter == 'http_retries')
+    lines.append(f"http retries: {retries:g}")
+    await interaction.response.send_message("```\n" + "\n".join(lines)[:1900] + "\n```", ephemeral=True)
+
+# Follow command
+@app_commands.command(name="follow", description="Get a DM when a creator posts new chapters")
+@app_commands.describe(creator="Creator name from list", auto_epub="Also send an EPUB of the new chapters (optional)")
+async def follow(interaction: discord.Interaction, creator: str, auto_epub: bool = False):
+    if not await check_role(interaction) or not await check_channel(interaction):
+        return
+    if creator_registry.get(creator) is None:
+        await interaction.response.send_message(f"{creator} is not in the creator list.", ephemeral=True, delete_after=10)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    followed = [name for name, _ in await subscriptions.following(interaction.user.id)]
+    if creator not in followed and len(followed) >= WATCH_MAX_FOLLOWS_PER_USER:
+        await interaction.edit_original_response(content=f"You can follow at most {WATCH_MAX_FOLLOWS_PER_USER} creators.")
+        return
+    await subscriptions.follow(interaction.user.id, creator, auto_epub)
+    try:
+        await creator_watcher.watch(creator)
+    except Exception as e:
+        logging.error(f"Failed to start watching '{creator}': {e}")
+    logging.info(f"{interaction.user} followed '{creator}' (auto_epub={auto_epub})")
+    await interaction.edit_original_response(
+        content=f"Following {creator}. New chapters will be sent to your DMs" + (" as EPUBs." if auto_epub else ".")
+    )
+
+follow.autocomplete('creator')(creator_autocomplete)
+
+# Unfollow command
+@app_commands.command(name="unfollow", description="Stop getting DMs about a creator")
+@app_commands.describe(creator="Followed creator name")
+async def unfollow(interaction: discord.Interaction, creator: str):
+    if not await check_role(interaction):
+        return
+
+    if await subscriptions.unfollow(interaction.user.id, creator):
+        await interaction.response.send_message(f"Unfollowed {creator}", ephemeral=True, delete_after=10)
+    else:
+        await interaction.response.send_message(f"You don't follow {creator}.", ephemeral=True, delete_after=10)
+
+# Autocomplete for unfollow, from the user's own follows
+async def followed_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    current = current.lower()
+    followed = await subscriptions.following(interaction.user.id)
+    return [app_commands.Choice(name=name, value=name) for name, _ in followed if current in name.lower()][:25]
+
+unfollow.autocomplete('creator')(followed_autocomplete)
+
+# Following command
+@app_commands.command(name="following", description="List the creators you follow")
+async def following(interaction: discord.Interaction):
+    if not await check_role(interaction):
+        return
+
+    followed = await subscriptions.following(interaction.user.id)
+    if not followed:
+        await interaction.response.send_message("You don't follow any creators.", ephemeral=True, delete_after=10)
+        return
+    lines = [f"- {name}" + (" (EPUB)" if auto_epub else "") for name, auto_epub in followed]
+    await interaction.response.send_message("You follow:\n" + "\n".join(lines), ephemeral=True)
+
+# Throttled status updates shown on the interaction's ephemeral response
+def status_reporter(interaction: discord.Interaction, interval=2.0):
+    last_update = 0.0
+
+    async def report(text, force=False):
+        nonlocal last_update
+        now = time.monotonic()
+        if not force and now - last_update < interval:
+            return
+        last_update = now
         try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    text = await resp.text()
-                    match = re.search(r'"creator":\s*{\s*"data":\s*{\s*"id":\s*"(\d+)"', text)
-                    return match.group(1) if match else None
+            await interaction.edit_original_response(content=text)
+        except discord.HTTPException as e:
+            logging.warning(f"Failed to update progress message: {e}")
+
+    return report
+
+# Build the EPUB through the job scheduler and DM it to the requesting user
+async def send_epub(interaction: discord.Interaction, chapters, creator_name, url):
+    await deliver_epub(interaction.user, chapters, creator_name, url, status_reporter(interaction))
+
+# Build the EPUB through the job scheduler (or take it from the EPUB cache) and DM it to user
+async def deliver_epub(user, chapters, creator_name, url, listener=None):
+    filename = generate_filename(chapters)
+    key = EpubCache.key(url, creator_name, chapters)
+
+    async def build(progress):
+        volumes = await create_epub(chapters, creator_name, creator_name, url, progress=progress)
+        epub_cache.put(key, volumes)
+        return volumes
+
+    volumes = epub_cache.get(key)
+    metrics.count('cache_requests', cache='epub', result='miss' if volumes is None else 'hit')
+    if volumes is None:
+        volumes = await job_scheduler.submit(user.id, key, build, listener)
+    else:
+        logging.info(f"EPUB '{filename}.epub' served from cache")
+    for number, epub_data in enumerate(volumes, start=1):
+        volume_name = f"{filename} Vol {number}" if len(volumes) > 1 else filename
+        with metrics.timer('upload'):
+            await user.send(
+                f"Fetched from **[{creator_name}](<{url.replace('/api/v1/', '/')}>)**."
+                + (f" Volume {number} of {len(volumes)}." if len(volumes) > 1 else ""),
+                file=discord.File(io.BytesIO(epub_data), f"{volume_name}.epub")
+            )
+        metrics.count('upload_bytes', len(epub_data))
+    logging.info(f"EPUB '{filename}.epub' ({len(volumes)} volumes) sent to {user} for creator '{creator_name}'")
+
+# DM each follower the titles of a followed creator's new posts, plus an EPUB of them for those who asked for one
+async def notify_followers(creator, feed_url, summaries, followers):
+    titles = "\n".join(f"- {summary.title}" for summary in reversed(summaries[:10]))
+    more = f"\n...and {len(summaries) - 10} more" if len(summaries) > 10 else ""
+    text = (f"**[{creator}](<{feed_url.replace('/api/v1/', '/')}>)** posted {len(summaries)} new "
+            f"chapter{'s' if len(summaries) > 1 else ''}:\n{titles}{more}")
+    epub_users = []
+    for user_id, auto_epub in followers:
+        try:
+            user = client.get_user(user_id) or await client.fetch_user(user_id)
+            await user.send(text)
+        except Exception as e:
+            logging.error(f"Failed to notify {user_id} about new '{creator}' chapters: {e}")
+            continue
+        if auto_epub:
+            epub_users.append(user)
+    # EPUBs are built and sent in the background so the watcher's poll slot is freed right away
+    if epub_users:
+        task = asyncio.create_task(deliver_follower_epubs(creator, feed_url, summaries, epub_users))
+        follower_deliveries.add(task)
+        task.add_done_callback(follower_deliveries.discard)
+
+# EPUB deliveries started by notify_followers that are still running
+follower_deliveries = set()
+
+# Send one EPUB of a followed creator's new posts to each user; identical builds are merged by the job scheduler
+async def deliver_follower_epubs(creator, feed_url, summaries, users):
+    try:
+        chapters = await load_chapters(feed_url, summaries)
+    except Exception as e:
+        logging.error(f"Failed to load new '{creator}' chapters: {e}")
+        return
+
+    async def deliver(user):
+        try:
+            await deliver_epub(user, chapters, creator, feed_url)
+        except QueueFullError as e:
+            logging.warning(f"Skipped EPUB of new '{creator}' chapters for {user}: {e}")
         except Exception as e:
-            logging.error(f"Error getting Patreon ID: {e}")
-            return None
-
-# Fetch chapters from Kemono API with offset
-async def fetch_chapters(feed_url, max_chapters, offset=0):
-    chapters = []
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{feed_url}?o={offset}") as resp:
-            if resp.status != 200:
-                logging.error(f"Failed to fetch chapters: {resp.status}")
-                return []
-            chapters = await resp.json()
-            return sorted(chapters[:max_chapters], key=lambda x: x.get('published', ''), reverse=True)
-
-# Create EPUB file from chapters
-async def create_epub(chapters, title, author, profile_url, filename):
-    book = epub.EpubBook()
-    book.set_language("en")
-    book.set_title(title)
-    book.add_author(author)
-    chapters = sorted(chapters, key=lambda x: x['published'])
-    epub_chapters = []
-
-    async with aiohttp.ClientSession() as session:
-        for i, chapter in enumerate(chapters, start=1):
-            chapter_title = chapter['title']
-            content = f"<h1>{chapter_title}</h1>\n<p>{chapter.get('content', '')}</p>"
-            matches = re.findall(r'<img[^>]+src="([^"]+)"', content)
-            for i2, match in enumerate(matches):
-                full_url = "https://n4.kemono.su/data" + match
-                try:
-                    async with session.get(full_url) as resp:
-                        if resp.status == 200:
-                            media_type = resp.headers.get('Content-Type', 'image/jpeg')
-                            image_name = match.split('/')[-1]
-                            image_content = await resp.read()
-                            image_item = epub.EpubItem(uid=f"img{i2+1}", file_name=f"images/{image_name}", 
-                                                      media_type=media_type, content=image_content)
-                            book.add_item(image_item)
-                            content = content.replace(match, f"images/{image_name}")
-                except Exception as e:
-                    logging.error(f"Failed to download image {full_url}: {e}")
-            
-            chapter_epub = epub.EpubHtml(title=chapter_title, file_name=f'chap_{i:02}.xhtml', lang='en')
-            chapter_epub.content = content
-            epub_chapters.append(chapter_epub)
-            book.add_item(chapter_epub)
-
-    book.toc = tuple(epub_chapters)
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = ['nav'] + epub_chapters
-    temp_filepath = os.path.join(os.getcwd(), f"{filename}.epub")
-    epub.write_epub(temp_filepath, book)
-    return temp_filepath
-
-# Sanitize filename
-def sanitize_filename(filename):
-    return re.sub(r'[^\w\s-]', '', filename).strip() or "untitled"
-
-# Generate filename from chapters
-def generate_filename(chapters):
-    if not chapters:
-        return "empty_chapters"
-    lowermost = chapters[-1].get('title', 'untitled')
-    uppermost = chapters[0].get('title', 'untitled')
-    return f"{sanitize_filename(lowermost[:15])}-{sanitize_filename(uppermost[:15])}" if len(chapters) > 1 else sanitize_filename(uppermost)
+            logging.error(f"Failed to send EPUB of new '{creator}' chapters to {user}: {e}")
+
+    await asyncio.gather(*(deliver(user) for user in users))
+
+creator_watcher = CreatorWatcher(subscriptions, notify_followers)
+
+# Check the command was used in the fetch channel
+async def check_channel(interaction: discord.Interaction):
+    if str(interaction.channel_id) == fetch_channel_id:
+        return True
+    await interaction.response.send_message(f"This command can only be used in <#{fetch_channel_id}>.", ephemeral=True, delete_after=10)
+    return False
 
 # Check user roles
 async def check_role(interaction: discord.Interaction, require_admin=False):
@@ -436,13 +521,18 @@ async def check_role(interaction: discord.Interaction, require_admin=False):
     await interaction.response.send_message(f"You lack {'admin' if require_admin else 'required'} role.", ephemeral=True, delete_after=10)
     return False
 
-@client.event
-async def on_disconnect():
-    logging.info("Bot disconnected from Discord Gateway. Reconnect attempts may follow...")
-
-@client.event
-async def on_ready():
-    await tree.sync(guild=discord.Object(id=guild_id))
-    logging.info(f'{client.user} connected and commands synced to guild {guild_id}!')
-
-client.run(bot_token)
+# Load the configuration, create the client and register the commands to the guild
+def main():
+    global bot_token, guild_id, fetch_channel_id, allowed_roles, admin_roles, client, tree
+    setup_logging()
+    bot_token, guild_id, fetch_channel_id, allowed_roles, admin_roles = setup_bot()
+    intents = discord.Intents.default()
+    intents.message_content = True
+    client = FetchBot(intents=intents)
+    tree = app_commands.CommandTree(client)
+    for command in (fetch, add_creator, remove_creator, stats, follow, unfollow, following):
+        tree.add_command(command, guild=discord.Object(id=guild_id))
+    client.run(bot_token)
+
+if __name__ == '__main__':
+    main()
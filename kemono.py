@@ -0,0 +1,1768 @@
+# Kemono client and EPUB builder shared by the Discord bot and the batch exporter. Importing this module has
+# no side effects: files, databases, connections and worker processes are only opened on first use.
+import argparse
+import asyncio
+import logging
+import aiohttp
+from aiohttp import web
+import os
+import json
+import hashlib
+import heapq
+import html
+import io
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+import mimetypes
+import multiprocessing
+from ebooklib import epub
+import itertools
+import re
+import sys
+
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Constants
+CREATORS_FILE = 'creators.txt'
+KEMONO_URL = 'https://kemono.su'
+KEMONO_DATA_URL = 'https://n4.kemono.su/data'
+
+# HTTP client settings (connection caps and request rates are per host)
+HTTP_TOTAL_CONNECTIONS = 32
+HTTP_DEFAULT_HOST_LIMIT = 4
+HTTP_HOST_LIMITS = {'kemono.su': 4, 'n4.kemono.su': 8}
+HTTP_DEFAULT_RATE = 5.0
+HTTP_HOST_RATES = {'kemono.su': 3.0, 'n4.kemono.su': 10.0}
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30.0
+HTTP_RETRY_AFTER_MAX = 60.0
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_TIMEOUT = 60
+
+# Number of images downloaded in parallel for a single EPUB
+IMAGE_CONCURRENCY = 8
+
+# Optional image downscaling (requires Pillow), used when a book's images don't fit in EPUB_SIZE_BUDGET.
+# Books that still don't fit are split into volumes of at most EPUB_SIZE_BUDGET bytes each.
+IMAGE_TRANSCODE = True
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+IMAGE_MAX_DIMENSION = 1600
+IMAGE_JPEG_QUALITY = 80
+EPUB_SIZE_BUDGET = 9 * 1024 ** 2
+
+# On-disk image cache shared by all EPUB builds
+IMAGE_CACHE_DIR = os.path.join('cache', 'images')
+IMAGE_CACHE_MAX_BYTES = 1024 ** 3
+
+# Metrics: timings kept per stage for percentiles, and the local Prometheus listener (port 0 disables it)
+METRICS_WINDOW = 1000
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Local post index; a creator synced within POST_INDEX_FRESHNESS seconds is served without any request
+POST_INDEX_DB = os.path.join('cache', 'posts.db')
+POST_INDEX_FRESHNESS = 60
+KEMONO_PAGE_SIZE = 50
+
+# Number of feed pages requested in parallel when a caller needs more than one page
+FEED_CONCURRENCY = 4
+
+# Cached Patreon link and creator profile lookups; failed lookups are retried after the shorter negative TTL
+RESOLUTION_DB = os.path.join('cache', 'resolved.db')
+RESOLUTION_TTL = 30 * 24 * 3600
+RESOLUTION_NEGATIVE_TTL = 600
+
+# Download job scheduler: number of EPUB builds running at once and queued jobs allowed per user
+JOB_WORKERS = 2
+JOB_MAX_QUEUED_PER_USER = 3
+
+# Finished EPUBs kept in memory for repeat requests
+EPUB_CACHE_MAX_BYTES = 256 * 1024 ** 2
+EPUB_CACHE_TTL = 6 * 3600
+
+# Followed creators: each one is polled about every WATCH_INTERVAL seconds, give or take WATCH_JITTER of it
+FOLLOWS_DB = 'follows.db'
+WATCH_INTERVAL = 15 * 60
+WATCH_JITTER = 0.2
+WATCH_CONCURRENCY = 4
+WATCH_MAX_NEW_POSTS = 20
+WATCH_MAX_FOLLOWS_PER_USER = 25
+
+# Batch export: creators built at once and the most chapters exported per creator
+BATCH_CONCURRENCY = 4
+BATCH_MAX_CHAPTERS = 5000
+
+# In-memory registry of creators.txt. The file is re-parsed only when its mtime or size changes and is rewritten
+# atomically. Every substring of up to 3 characters of each lowercased name is indexed for autocomplete.
+class CreatorRegistry:
+    GRAM_SIZE = 3
+
+    def __init__(self, path=CREATORS_FILE):
+        self.path = path
+        self._creators = {}
+        self._keys = []
+        self._grams = {}
+        self._stamp = None
+        self._loaded = False
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        stamp = self._file_stamp()
+        if self._loaded and stamp == self._stamp:
+            return
+        creators = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if '=' in line:
+                        name, url = map(str.strip, line.split('=', 1))
+                        creators[name] = url
+        except FileNotFoundError:
+            logging.warning(f"{self.path} not found. Using empty creator list.")
+        self._index(creators)
+        self._stamp = stamp
+        self._loaded = True
+
+    def _index(self, creators):
+        self._creators = creators
+        self._keys = sorted((name.lower(), name) for name in creators)
+        self._grams = {}
+        for key, name in self._keys:
+            grams = {key[i:i + n] for n in range(1, self.GRAM_SIZE + 1) for i in range(len(key) - n + 1)}
+            for gram in grams:
+                self._grams.setdefault(gram, []).append((key, name))
+
+    def _save(self, creators):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            for name, url in creators.items():
+                f.write(f"{name} = {url}\n")
+        os.replace(temp_path, self.path)
+        self._index(creators)
+        self._stamp = self._file_stamp()
+
+    def get(self, name):
+        self._refresh()
+        return self._creators.get(name)
+
+    def items(self):
+        self._refresh()
+        return list(self._creators.items())
+
+    def add(self, name, url):
+        self._refresh()
+        self._save({**self._creators, name: url})
+
+    def remove(self, name):
+        self._refresh()
+        if name not in self._creators:
+            return False
+        self._save({n: u for n, u in self._creators.items() if n != name})
+        return True
+
+    # Names containing query (case-insensitive), ranked by match position and then alphabetically
+    def search(self, query, limit=25):
+        self._refresh()
+        query = query.lower()
+        if not query:
+            candidates = self._keys
+        elif len(query) <= self.GRAM_SIZE:
+            candidates = self._grams.get(query, [])
+        else:
+            candidates = min((self._grams.get(query[i:i + self.GRAM_SIZE], []) for i in range(len(query) - self.GRAM_SIZE + 1)), key=len)
+        matches = ((key.find(query), key, name) for key, name in candidates if query in key)
+        return [name for _, _, name in heapq.nsmallest(limit, matches)]
+
+creator_registry = CreatorRegistry()
+
+# Stage timings and counters. Each stage keeps its last METRICS_WINDOW timings for rolling percentiles plus
+# running totals; everything is exported in Prometheus text format and summarised by /stats.
+class Metrics:
+    PREFIX = 'kemono'
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.counters = defaultdict(float)
+        self.timings = {}
+
+    def count(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, stage, seconds):
+        if stage not in self.timings:
+            self.timings[stage] = [deque(maxlen=self.window), 0, 0.0]
+        timing = self.timings[stage]
+        timing[0].append(seconds)
+        timing[1] += 1
+        timing[2] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def percentiles(self, stage, quantiles=(0.5, 0.9, 0.99)):
+        samples = sorted(self.timings[stage][0])
+        return [samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles]
+
+    # Hits / (hits + misses) for a cache, or None if it was never used
+    def hit_ratio(self, cache):
+        hits = self.counters.get(('cache_requests', (('cache', cache), ('result', 'hit'))), 0)
+        misses = self.counters.get(('cache_requests', (('cache', cache), ('result', 'miss'))), 0)
+        return hits / (hits + misses) if hits + misses else None
+
+    @staticmethod
+    def _labels(labels):
+        escaped = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}" if labels else ""
+
+    # Counter values in full precision; whole numbers are written without an exponent or fraction
+    @staticmethod
+    def _number(value):
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def render_prometheus(self):
+        lines = []
+        by_name = defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            by_name[name].append((labels, value))
+        for name, series in by_name.items():
+            lines.append(f"# TYPE {self.PREFIX}_{name}_total counter")
+            lines.extend(f"{self.PREFIX}_{name}_total{self._labels(labels)} {self._number(value)}" for labels, value in series)
+        if self.timings:
+            lines.append(f"# TYPE {self.PREFIX}_stage_seconds summary")
+        for stage, (samples, count, total) in sorted(self.timings.items()):
+            for q, value in zip((0.5, 0.9, 0.99), self.percentiles(stage)):
+                lines.append(f"{self.PREFIX}_stage_seconds{self._labels((('stage', stage), ('quantile', q)))} {value:.6f}")
+            lines.append(f"{self.PREFIX}_stage_seconds_sum{self._labels((('stage', stage),))} {total:.6f}")
+            lines.append(f"{self.PREFIX}_stage_seconds_count{self._labels((('stage', stage),))} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Serve metrics.render_prometheus() on http://METRICS_HOST:METRICS_PORT/metrics; returns the runner to clean up
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Metrics available on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# Token bucket limiting the request rate to a single host
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Hold back every request to this host for the given number of seconds (e.g. after a 429). Refill restarts
+    # from now, so time spent before the pause doesn't pay it off.
+    def pause(self, seconds):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+# Fully read HTTP response, safe to use after the connection went back to the pool
+class HttpResponse:
+    __slots__ = ('url', 'status', 'headers', 'body')
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def text(self):
+        return self.body.decode('utf-8', errors='replace')
+
+# Parse a Retry-After header given either in seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Shared HTTP client: one keep-alive connection pool, per-host connection caps and rate limits,
+# and jittered exponential backoff on transient failures
+class HttpClient:
+    def __init__(self, total_limit=HTTP_TOTAL_CONNECTIONS, host_limits=None, host_rates=None,
+                 max_retries=HTTP_MAX_RETRIES, timeout=HTTP_TIMEOUT):
+        self.total_limit = total_limit
+        self.host_limits = HTTP_HOST_LIMITS if host_limits is None else host_limits
+        self.host_rates = HTTP_HOST_RATES if host_rates is None else host_rates
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._session = None
+        self._semaphores = {}
+        self._buckets = {}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.total_limit, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _host_slot(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, HTTP_DEFAULT_HOST_LIMIT))
+            self._buckets[host] = TokenBucket(self.host_rates.get(host, HTTP_DEFAULT_RATE))
+        return self._semaphores[host], self._buckets[host]
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    async def request(self, method, url, **kwargs):
+        host = urlsplit(url).hostname or ''
+        semaphore, bucket = self._host_slot(host)
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with semaphore:
+                    await bucket.acquire()
+                    async with self._get_session().request(method, url, **kwargs) as resp:
+                        body = await resp.read()
+                        response = HttpResponse(str(resp.url), resp.status, resp.headers.copy(), body)
+                metrics.count('http_requests', host=host, status=response.status)
+                metrics.count('http_bytes', len(body), host=host)
+                if response.status not in HTTP_RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    if retry_after > HTTP_RETRY_AFTER_MAX:
+                        return response
+                    bucket.pause(retry_after)
+                logging.warning(f"HTTP {response.status} from {url}, retrying ({attempt + 1}/{self.max_retries})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.count('http_errors', host=host)
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"HTTP error for {url}: {e!r}, retrying ({attempt + 1}/{self.max_retries})")
+            metrics.count('http_retries', host=host)
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+http_client = HttpClient()
+
+# Persistent image cache keyed by Kemono data path, evicting least recently used entries past max_bytes.
+# Each entry is one file holding the Content-Type on the first line followed by the image bytes.
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total = 0
+        self._loaded = False
+        self._loading = None
+        self._inflight = {}
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    # Rebuild the LRU order from file modification times, which are bumped on every hit
+    def _scan(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, path, stat.st_size))
+        return sorted(found)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        media_type, _, content = data.partition(b'\n')
+        return media_type.decode(), content
+
+    def _write(self, path, media_type, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(media_type.encode() + b'\n')
+            f.write(content)
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Scan the directory once; concurrent first callers all wait for the same scan
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load())
+            await asyncio.shield(self._loading)
+
+    async def _load(self):
+        try:
+            found = await asyncio.to_thread(self._scan)
+        except BaseException:
+            self._loading = None
+            raise
+        for _, path, size in found:
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+        self._loaded = True
+        await self._evict()
+
+    async def _evict(self):
+        evicted = []
+        while self._total > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total -= size
+            evicted.append(path)
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+
+    async def get(self, key):
+        await self._ensure_loaded()
+        path = self._path(key)
+        if path not in self._entries:
+            return None
+        self._entries.move_to_end(path)
+        entry = await asyncio.to_thread(self._read, path)
+        if entry is None:
+            self._total -= self._entries.pop(path, 0)
+        return entry
+
+    async def put(self, key, media_type, content):
+        await self._ensure_loaded()
+        if len(content) > self.max_bytes:
+            return
+        path = self._path(key)
+        size = await asyncio.to_thread(self._write, path, media_type, content)
+        self._total += size - self._entries.pop(path, 0)
+        self._entries[path] = size
+        await self._evict()
+
+    # Return the cached (media_type, content) for key, or run download() once for all concurrent callers
+    async def fetch(self, key, download):
+        if key not in self._inflight:
+            entry = await self.get(key)
+            if entry is not None:
+                metrics.count('cache_requests', cache='image', result='hit')
+                return entry
+        task = self._inflight.get(key)
+        metrics.count('cache_requests', cache='image', result='miss' if task is None else 'shared')
+        if task is None:
+            task = asyncio.ensure_future(self._download(key, download))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, key, download):
+        entry = await download()
+        if entry is not None:
+            try:
+                await self.put(key, *entry)
+            except OSError as e:
+                logging.error(f"Failed to cache image {key}: {e}")
+        return entry
+
+image_cache = ImageCache()
+
+# In-memory cache of finished EPUB volumes, bounded by total size and age. Keys include every post's id and its
+# edited/published stamp, and entries containing a post are dropped as soon as the post index sees it change.
+class EpubCache:
+    def __init__(self, max_bytes=EPUB_CACHE_MAX_BYTES, ttl=EPUB_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._total = 0
+        self._by_post = {}
+
+    @staticmethod
+    def key(url, title, chapters):
+        stamps = sorted((str(c['id']), c.get('edited') or c.get('published') or '') for c in chapters)
+        return url, title, tuple(stamps)
+
+    def _post_keys(self, key):
+        creator_key = parse_feed_url(key[0])
+        return [(creator_key, post_id) for post_id, _ in key[2]] if creator_key else []
+
+    def _discard(self, key):
+        expires, volumes = self._entries.pop(key)
+        self._total -= sum(map(len, volumes))
+        for post_key in self._post_keys(key):
+            keys = self._by_post.get(post_key)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_post[post_key]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, volumes):
+        size = sum(map(len, volumes))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._discard(key)
+        self._entries[key] = (time.monotonic() + self.ttl, volumes)
+        self._total += size
+        for post_key in self._post_keys(key):
+            self._by_post.setdefault(post_key, set()).add(key)
+        while self._total > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, service, creator_id, post_ids):
+        for post_id in post_ids:
+            for key in list(self._by_post.get(((service, creator_id), str(post_id)), ())):
+                self._discard(key)
+
+epub_cache = EpubCache()
+
+# Compact chapter record kept by chapter selection views; the post content is loaded only when downloading
+class ChapterSummary:
+    __slots__ = ('id', 'title', 'published', 'edited')
+
+    def __init__(self, id, title, published, edited=None):
+        self.id = str(id)
+        self.title = title or 'Untitled'
+        self.published = published
+        self.edited = edited
+
+    @classmethod
+    def from_post(cls, post):
+        return cls(post['id'], post.get('title'), post.get('published'), post.get('edited'))
+
+# SQLite database file owned by one store; SCHEMA is applied on first use and queries run in a worker thread
+class SqliteStore:
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    # Run func(db, *args) in a worker thread inside a transaction
+    async def _run(self, func, *args):
+        def call():
+            with self._db_lock:
+                if self._db is None:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    self._db = sqlite3.connect(self.path, check_same_thread=False)
+                    self._db.executescript(self.SCHEMA)
+                with self._db:
+                    return func(self._db, *args)
+        return await asyncio.to_thread(call)
+
+# Local SQLite index of creator posts. Each sync only fetches feed pages from offset 0 until it reaches an
+# already indexed post id; older pages are fetched once, when a caller first reads past what is indexed.
+# `depth` counts the newest posts held without gaps, `complete` marks that the end of the feed was reached.
+class PostIndex(SqliteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS posts (
+            service TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            post_id TEXT NOT NULL,
+            title TEXT,
+            published TEXT,
+            edited TEXT,
+            content TEXT,
+            PRIMARY KEY (service, creator_id, post_id)
+        );
+        CREATE INDEX IF NOT EXISTS posts_by_published ON posts (service, creator_id, published);
+        CREATE TABLE IF NOT EXISTS creators (
+            service TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            depth INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0,
+            synced_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (service, creator_id)
+        );
+        CREATE TABLE IF NOT EXISTS feed_validators (
+            service TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            PRIMARY KEY (service, creator_id)
+        );
+    """
+
+    def __init__(self, path=POST_INDEX_DB):
+        super().__init__(path)
+        self._sync_locks = {}
+
+    @staticmethod
+    def _state(db, service, creator_id):
+        row = db.execute("SELECT depth, complete, synced_at FROM creators WHERE service = ? AND creator_id = ?",
+                         (service, creator_id)).fetchone()
+        return row or (0, 0, 0.0)
+
+    @staticmethod
+    def _known_ids(db, service, creator_id):
+        rows = db.execute("SELECT post_id FROM posts WHERE service = ? AND creator_id = ?", (service, creator_id))
+        return {row[0] for row in rows}
+
+    @staticmethod
+    def _validators(db, service, creator_id):
+        row = db.execute("SELECT etag, last_modified FROM feed_validators WHERE service = ? AND creator_id = ?",
+                         (service, creator_id)).fetchone()
+        return row or (None, None)
+
+    @staticmethod
+    def _touch(db, service, creator_id, synced_at):
+        db.execute("UPDATE creators SET synced_at = ? WHERE service = ? AND creator_id = ?", (synced_at, service, creator_id))
+
+    @staticmethod
+    def _store(db, service, creator_id, posts, depth, complete, synced_at, validators=None):
+        fields = ('title', 'published', 'edited', 'content')
+        stored = PostIndex._select_by_id(db, service, creator_id, [str(post['id']) for post in posts])
+        changed = [
+            str(post['id']) for post in posts if str(post['id']) in stored
+            and any(stored[str(post['id'])][field] != post.get(field) for field in fields)
+        ]
+        # Only new and changed posts are written; unchanged ones are skipped
+        writes = set(changed)
+        db.executemany(
+            "INSERT OR REPLACE INTO posts (service, creator_id, post_id, title, published, edited, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(service, creator_id, str(post['id']), post.get('title'), post.get('published'), post.get('edited'),
+              post.get('content')) for post in posts if str(post['id']) not in stored or str(post['id']) in writes]
+        )
+        db.execute("INSERT OR REPLACE INTO creators (service, creator_id, depth, complete, synced_at) VALUES (?, ?, ?, ?, ?)",
+                   (service, creator_id, depth, int(complete), synced_at))
+        if validators is not None:
+            db.execute("INSERT OR REPLACE INTO feed_validators (service, creator_id, etag, last_modified) VALUES (?, ?, ?, ?)",
+                       (service, creator_id, *validators))
+        return changed
+
+    @staticmethod
+    def _select(db, service, creator_id, count, offset):
+        rows = db.execute(
+            "SELECT post_id, title, published, edited, content FROM posts WHERE service = ? AND creator_id = ? "
+            "ORDER BY published DESC LIMIT ? OFFSET ?",
+            (service, creator_id, count, offset)
+        )
+        return [dict(zip(('id', 'title', 'published', 'edited', 'content'), row)) for row in rows]
+
+    @staticmethod
+    def _select_summaries(db, service, creator_id, count, offset):
+        rows = db.execute(
+            "SELECT post_id, title, published, edited FROM posts WHERE service = ? AND creator_id = ? "
+            "ORDER BY published DESC LIMIT ? OFFSET ?",
+            (service, creator_id, count, offset)
+        )
+        return [ChapterSummary(*row) for row in rows]
+
+    @staticmethod
+    def _select_by_id(db, service, creator_id, post_ids):
+        posts = {}
+        for start in range(0, len(post_ids), 500):
+            chunk = post_ids[start:start + 500]
+            rows = db.execute(
+                "SELECT post_id, title, published, edited, content FROM posts WHERE service = ? AND creator_id = ? "
+                f"AND post_id IN ({', '.join('?' * len(chunk))})",
+                (service, creator_id, *chunk)
+            )
+            posts.update((row[0], dict(zip(('id', 'title', 'published', 'edited', 'content'), row))) for row in rows)
+        return posts
+
+    async def _store_posts(self, service, creator_id, posts, depth, complete, synced_at, validators=None):
+        changed = await self._run(self._store, service, creator_id, posts, depth, complete, synced_at, validators)
+        if changed:
+            logging.info(f"{len(changed)} indexed posts changed for {service}/{creator_id}")
+            epub_cache.invalidate(service, creator_id, changed)
+
+    async def _sync(self, feed_url, service, creator_id):
+        depth, complete, synced_at = await self._run(self._state, service, creator_id)
+        if time.time() - synced_at < POST_INDEX_FRESHNESS:
+            return
+        known = await self._run(self._known_ids, service, creator_id)
+        # The newest page is requested conditionally; an unchanged feed costs a single 304 response
+        validators = await self._run(self._validators, service, creator_id) if known else (None, None)
+        status, page, validators = await fetch_feed_head(feed_url, validators)
+        if status == 304:
+            await self._run(self._touch, service, creator_id, time.time())
+            return
+        # Every fetched post is stored, not only the new ones, so edits to known posts on these pages are picked up
+        new_posts = []
+        fetched = []
+        offset = 0
+        while True:
+            if page is None:
+                return
+            fetched.extend(page)
+            fresh = list(itertools.takewhile(lambda post: str(post['id']) not in known, page))
+            new_posts.extend(fresh)
+            if len(fresh) < len(page):
+                depth += len(new_posts)
+                break
+            if len(page) < KEMONO_PAGE_SIZE or not known:
+                depth, complete = offset + len(page), len(page) < KEMONO_PAGE_SIZE
+                break
+            offset += KEMONO_PAGE_SIZE
+            page = await fetch_feed_page(feed_url, offset)
+        await self._store_posts(service, creator_id, fetched, depth, complete, time.time(), validators)
+        if new_posts:
+            logging.info(f"Indexed {len(new_posts)} new posts for {service}/{creator_id}")
+
+    # Extend the index with older feed pages until it covers `needed` posts or the feed ends
+    async def _backfill(self, feed_url, service, creator_id, needed):
+        depth, complete, synced_at = await self._run(self._state, service, creator_id)
+        if complete or depth >= needed:
+            return
+        posts = []
+        for offset, page in await fetch_feed_pages(feed_url, depth, needed - depth):
+            posts.extend(page)
+            depth, complete = max(depth, offset + len(page)), len(page) < KEMONO_PAGE_SIZE
+        if posts:
+            await self._store_posts(service, creator_id, posts, depth, complete, synced_at)
+
+    async def _update(self, feed_url, service, creator_id, needed):
+        lock = self._sync_locks.setdefault((service, creator_id), asyncio.Lock())
+        async with lock:
+            with metrics.timer('index_sync'):
+                await self._sync(feed_url, service, creator_id)
+                await self._backfill(feed_url, service, creator_id, needed)
+
+    # Return up to `count` posts starting at `offset`, newest first
+    async def get_posts(self, feed_url, service, creator_id, count, offset=0):
+        await self._update(feed_url, service, creator_id, offset + count)
+        return await self._run(self._select, service, creator_id, count, offset)
+
+    # Same as get_posts, but returns ChapterSummary records without the post content
+    async def get_summaries(self, feed_url, service, creator_id, count, offset=0):
+        await self._update(feed_url, service, creator_id, offset + count)
+        return await self._run(self._select_summaries, service, creator_id, count, offset)
+
+    # Return {post_id: post} for the indexed posts among post_ids
+    async def get_by_id(self, service, creator_id, post_ids):
+        return await self._run(self._select_by_id, service, creator_id, list(post_ids))
+
+post_index = PostIndex()
+
+# Persistent cache of slow lookups: Patreon link -> Kemono feed URL, and creator -> profile display name.
+# Failed lookups are stored as empty strings and expire after RESOLUTION_NEGATIVE_TTL.
+class ResolutionCache(SqliteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS links (
+            link TEXT PRIMARY KEY,
+            feed_url TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS profiles (
+            service TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            expires REAL NOT NULL,
+            PRIMARY KEY (service, creator_id)
+        );
+    """
+
+    def __init__(self, path=RESOLUTION_DB):
+        super().__init__(path)
+
+    @staticmethod
+    def _lookup(db, query, args):
+        row = db.execute(query, args).fetchone()
+        return row[0] if row and row[1] > time.time() else None
+
+    @staticmethod
+    def _expiry(value):
+        return time.time() + (RESOLUTION_TTL if value else RESOLUTION_NEGATIVE_TTL)
+
+    # Cached feed URL for link: None if unknown or expired, '' if the link is known not to resolve
+    async def get_link(self, link):
+        return await self._run(self._lookup, "SELECT feed_url, expires FROM links WHERE link = ?", (link,))
+
+    async def put_link(self, link, feed_url):
+        await self._run(lambda db: db.execute("INSERT OR REPLACE INTO links (link, feed_url, expires) VALUES (?, ?, ?)",
+                                              (link, feed_url or '', self._expiry(feed_url))))
+
+    # Cached display name: None if unknown or expired, '' if the creator has no profile
+    async def get_name(self, service, creator_id):
+        return await self._run(self._lookup, "SELECT name, expires FROM profiles WHERE service = ? AND creator_id = ?",
+                               (service, creator_id))
+
+    async def put_name(self, service, creator_id, name):
+        await self._run(lambda db: db.execute(
+            "INSERT OR REPLACE INTO profiles (service, creator_id, name, expires) VALUES (?, ?, ?, ?)",
+            (service, creator_id, name or '', self._expiry(name))
+        ))
+
+resolution_cache = ResolutionCache()
+
+class QueueFullError(Exception):
+    pass
+
+# A queued EPUB build. Identical requests share one job; every listener gets its status updates and result.
+class DownloadJob:
+    def __init__(self, key, build):
+        self.key = key
+        self.build = build
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.listeners = []
+        self.position = None
+        self.queued_at = None
+
+    async def notify(self, text, force=False):
+        for listener in list(self.listeners):
+            try:
+                await listener(text, force)
+            except Exception as e:
+                logging.warning(f"Status update for download job {self.key} failed: {e}")
+
+# Runs download jobs on a bounded pool of workers. Each user has their own queue and workers take jobs from
+# the queues round-robin, so one user's burst can't starve everyone else. A job identical to one that is
+# already queued or running is merged into it instead of being built twice.
+class JobScheduler:
+    def __init__(self, workers=JOB_WORKERS, max_queued_per_user=JOB_MAX_QUEUED_PER_USER):
+        self.workers = workers
+        self.max_queued_per_user = max_queued_per_user
+        self._queues = OrderedDict()
+        self._jobs = {}
+        self._ready = None
+        self._tasks = []
+
+    def _ensure_started(self):
+        if not self._tasks:
+            self._ready = asyncio.Semaphore(0)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Queued jobs in the order workers will pick them up
+    def _queued_order(self):
+        queues = list(self._queues.values())
+        return [queue[i] for i in range(max(map(len, queues), default=0)) for queue in queues if i < len(queue)]
+
+    def _next_job(self):
+        user_id, queue = self._queues.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            self._queues[user_id] = queue
+        return job
+
+    # Tell jobs whose queue position changed; these updates go through the listeners' throttle
+    async def _announce_positions(self):
+        for position, job in enumerate(self._queued_order(), start=1):
+            if job.position != position:
+                job.position = position
+                await job.notify(f"Queued, position {position}...")
+
+    # Queue build(progress) for user_id, or join the identical job under key; returns the build result
+    async def submit(self, user_id, key, build, listener=None):
+        self._ensure_started()
+        job = self._jobs.get(key)
+        if job is None:
+            queue = self._queues.get(user_id, ())
+            if len(queue) >= self.max_queued_per_user:
+                raise QueueFullError(f"You already have {len(queue)} downloads queued, please wait for them to finish.")
+            job = DownloadJob(key, build)
+            job.queued_at = time.perf_counter()
+            self._jobs[key] = job
+            self._queues.setdefault(user_id, deque()).append(job)
+            self._ready.release()
+        if listener:
+            job.listeners.append(listener)
+            if job.position:
+                await listener(f"Queued, position {job.position}...", True)
+        await self._announce_positions()
+        return await asyncio.shield(job.future)
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            job = self._next_job()
+            job.position = None
+            try:
+                await self._announce_positions()
+                await self._run(job)
+            except Exception as e:
+                # Keep the worker alive; the job's callers get the error
+                logging.error(f"Download worker error on job {job.key}: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    async def _run(self, job):
+        async def progress(done, total, failed):
+            text = f"Downloading images {done}/{total}" + (f" ({failed} failed)" if failed else "") + "..."
+            await job.notify(text, force=done == total)
+
+        metrics.observe('queue_wait', time.perf_counter() - job.queued_at)
+        try:
+            await job.notify("Building EPUB...", force=True)
+            with metrics.timer('build'):
+                job.future.set_result(await job.build(progress))
+        except Exception as e:
+            logging.error(f"Download job {job.key} failed: {e}")
+            job.future.set_exception(e)
+        finally:
+            del self._jobs[job.key]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+job_scheduler = JobScheduler()
+
+# Creators from creators.txt followed by users, and the newest published date each creator was last checked at
+class SubscriptionStore(SqliteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS follows (
+            user_id TEXT NOT NULL,
+            creator TEXT NOT NULL,
+            auto_epub INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, creator)
+        );
+        CREATE INDEX IF NOT EXISTS follows_by_creator ON follows (creator);
+        CREATE TABLE IF NOT EXISTS watermarks (
+            creator TEXT PRIMARY KEY,
+            published TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=FOLLOWS_DB):
+        super().__init__(path)
+
+    async def follow(self, user_id, creator, auto_epub=False):
+        await self._run(lambda db: db.execute("INSERT OR REPLACE INTO follows (user_id, creator, auto_epub) VALUES (?, ?, ?)",
+                                              (str(user_id), creator, int(auto_epub))))
+
+    # Remove a follow; the creator's watermark goes with its last follower so a later follow starts fresh
+    @staticmethod
+    def _unfollow(db, user_id, creator):
+        removed = db.execute("DELETE FROM follows WHERE user_id = ? AND creator = ?", (str(user_id), creator)).rowcount
+        if not db.execute("SELECT 1 FROM follows WHERE creator = ? LIMIT 1", (creator,)).fetchone():
+            db.execute("DELETE FROM watermarks WHERE creator = ?", (creator,))
+        return removed > 0
+
+    async def unfollow(self, user_id, creator):
+        return await self._run(self._unfollow, user_id, creator)
+
+    # [(creator, auto_epub)] followed by user_id, by name
+    async def following(self, user_id):
+        return await self._run(lambda db: [(creator, bool(auto_epub)) for creator, auto_epub in db.execute(
+            "SELECT creator, auto_epub FROM follows WHERE user_id = ? ORDER BY creator", (str(user_id),))])
+
+    # [(user_id, auto_epub)] following creator
+    async def followers(self, creator):
+        return await self._run(lambda db: [(int(user_id), bool(auto_epub)) for user_id, auto_epub in db.execute(
+            "SELECT user_id, auto_epub FROM follows WHERE creator = ?", (creator,))])
+
+    async def creators(self):
+        return await self._run(lambda db: [row[0] for row in db.execute("SELECT DISTINCT creator FROM follows")])
+
+    async def get_watermark(self, creator):
+        row = await self._run(lambda db: db.execute("SELECT published FROM watermarks WHERE creator = ?", (creator,)).fetchone())
+        return row[0] if row else None
+
+    async def set_watermark(self, creator, published):
+        await self._run(lambda db: db.execute("INSERT OR REPLACE INTO watermarks (creator, published) VALUES (?, ?)",
+                                              (creator, published)))
+
+subscriptions = SubscriptionStore()
+
+# Single background poller for all followed creators. Each creator is polled once per round no matter how many
+# users follow it, at a jittered time so polls spread out instead of arriving in bursts. A poll is a post index
+# sync, which is one conditional feed request (a 304 when nothing changed) that stops at the first known post.
+# Posts published after the creator's watermark are passed to on_new_posts(creator, feed_url, summaries, followers).
+class CreatorWatcher:
+    def __init__(self, store, on_new_posts, interval=WATCH_INTERVAL, concurrency=WATCH_CONCURRENCY):
+        self.store = store
+        self.on_new_posts = on_new_posts
+        self.interval = interval
+        self.concurrency = concurrency
+        self._schedule = []
+        self._scheduled = set()
+        self._wake = None
+        self._task = None
+        self._polls = set()
+
+    def _next_delay(self):
+        return self.interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+    def _add(self, creator, delay):
+        if creator in self._scheduled:
+            return
+        self._scheduled.add(creator)
+        heapq.heappush(self._schedule, (time.monotonic() + delay, creator))
+        if self._wake is not None:
+            self._wake.set()
+
+    # Start polling every followed creator; first polls are spread evenly over one interval
+    async def start(self):
+        self._wake = asyncio.Event()
+        for creator in await self.store.creators():
+            self._add(creator, random.uniform(0, self.interval))
+        self._task = asyncio.create_task(self._loop())
+
+    # Record the creator's current newest post as its watermark (if it has none) and schedule its polls
+    async def watch(self, creator):
+        if await self.store.get_watermark(creator) is None:
+            await self.poll(creator)
+        self._add(creator, self._next_delay())
+
+    async def _loop(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            while self._schedule and self._schedule[0][0] <= now:
+                task = asyncio.create_task(self._poll_due(heapq.heappop(self._schedule)[1], semaphore))
+                self._polls.add(task)
+                task.add_done_callback(self._polls.discard)
+            timeout = self._schedule[0][0] - now if self._schedule else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_due(self, creator, semaphore):
+        async with semaphore:
+            try:
+                followers = await self.store.followers(creator)
+                if not followers:
+                    self._scheduled.discard(creator)
+                    return
+                await self.poll(creator, followers)
+            except Exception as e:
+                logging.error(f"Polling followed creator '{creator}' failed: {e}")
+        self._scheduled.discard(creator)
+        self._add(creator, self._next_delay())
+
+    # Sync the creator and move its watermark to the newest post. With followers given, posts newer than the
+    # previous watermark are reported; returns them newest first.
+    async def poll(self, creator, followers=None):
+        url = creator_registry.get(creator)
+        feed_url = await fix_link(url) if url else None
+        creator_key = parse_feed_url(feed_url) if feed_url else None
+        if not creator_key:
+            logging.warning(f"Followed creator '{creator}' is not in {CREATORS_FILE} or has an invalid URL")
+            return []
+        with metrics.timer('watch_poll'):
+            summaries = await post_index.get_summaries(feed_url, *creator_key, WATCH_MAX_NEW_POSTS)
+        watermark = await self.store.get_watermark(creator)
+        new_posts = [summary for summary in summaries if watermark is not None and (summary.published or '') > watermark]
+        if summaries and summaries[0].published and (watermark is None or summaries[0].published > watermark):
+            await self.store.set_watermark(creator, summaries[0].published)
+        if new_posts and followers:
+            logging.info(f"{len(new_posts)} new posts from followed creator '{creator}'")
+            await self.on_new_posts(creator, feed_url, new_posts, followers)
+        return new_posts
+
+    async def close(self):
+        for task in [self._task, *self._polls]:
+            if task is not None:
+                task.cancel()
+        self._task = None
+
+# Fix link to API format
+async def fix_link(link):
+    if not link or not isinstance(link, str):
+        return None
+    link = link.strip()
+    if "patreon.com" in link.lower():
+        link = link.rstrip('/')
+        feed_url = await resolution_cache.get_link(link)
+        metrics.count('cache_requests', cache='resolve', result='miss' if feed_url is None else 'hit')
+        if feed_url is not None:
+            return feed_url or None
+        try:
+            user_id = await get_patreon_id(link)
+        except Exception as e:
+            logging.error(f"Error getting Patreon ID: {e}")
+            return None
+        feed_url = f"https://kemono.su/api/v1/patreon/user/{user_id}" if user_id else None
+        await resolution_cache.put_link(link, feed_url)
+        return feed_url
+    if not link.startswith("http"):
+        link = f"https://{link.lstrip('/')}"
+    if link.startswith("https://kemono.su/") and not link.startswith("https://kemono.su/api/v1/"):
+        link = link.replace("https://kemono.su/", "https://kemono.su/api/v1/")
+    return link if "kemono.su/api/v1/" in link else None
+
+# Split an API feed URL into (service, creator_id), or None if it isn't one
+def parse_feed_url(feed_url):
+    parts = feed_url.split('?')[0].split('/')
+    if len(parts) >= 8 and parts[3] == 'api' and parts[4] == 'v1':
+        return parts[5], parts[7]
+    return None
+
+# Get Patreon ID from URL; None if the page has no creator id, raises if Patreon couldn't be reached
+async def get_patreon_id(url):
+    resp = await http_client.get(url)
+    if resp.status == 429 or resp.status >= 500:
+        raise IOError(f"Patreon returned HTTP {resp.status}")
+    if resp.status != 200:
+        return None
+    match = re.search(r'"creator":\s*{\s*"data":\s*{\s*"id":\s*"(\d+)"', resp.text())
+    return match.group(1) if match else None
+
+# Get a creator's display name from their Kemono profile, through the resolution cache
+async def get_creator_name(service, creator_id):
+    name = await resolution_cache.get_name(service, creator_id)
+    metrics.count('cache_requests', cache='resolve', result='miss' if name is None else 'hit')
+    if name is None:
+        with metrics.timer('profile'):
+            resp = await http_client.get(f"{KEMONO_URL}/api/v1/{service}/user/{creator_id}/profile")
+        if resp.status == 200:
+            name = resp.json().get('name') or ''
+        elif resp.status == 404:
+            name = ''
+        else:
+            return "Unknown"
+        await resolution_cache.put_name(service, creator_id, name)
+    return name or "Unknown"
+
+# Fetch one raw feed page from Kemono API, or None on failure
+async def fetch_feed_page(feed_url, offset):
+    with metrics.timer('feed'):
+        resp = await http_client.get(f"{feed_url}?o={offset}")
+    if resp.status != 200:
+        logging.error(f"Failed to fetch chapters: {resp.status}")
+        return None
+    return resp.json()
+
+# Fetch the newest feed page, sending the (etag, last_modified) validators saved from the previous fetch as
+# If-None-Match/If-Modified-Since. Returns (status, page, validators); page is None unless status is 200.
+async def fetch_feed_head(feed_url, validators):
+    etag, last_modified = validators
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    with metrics.timer('feed'):
+        resp = await http_client.get(f"{feed_url}?o=0", headers=headers)
+    if headers:
+        metrics.count('cache_requests', cache='feed', result='hit' if resp.status == 304 else 'miss')
+    if resp.status == 304:
+        return resp.status, None, validators
+    if resp.status != 200:
+        logging.error(f"Failed to fetch chapters: {resp.status}")
+        return resp.status, None, validators
+    return resp.status, resp.json(), (resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+
+# Fetch the feed pages covering posts [start, start + count) concurrently. Returns (offset, posts) pairs in
+# offset order, ending at the first failed or short page; pages past a short page are not requested.
+async def fetch_feed_pages(feed_url, start, count):
+    offsets = list(range(start // KEMONO_PAGE_SIZE * KEMONO_PAGE_SIZE, start + count, KEMONO_PAGE_SIZE))
+    semaphore = asyncio.Semaphore(FEED_CONCURRENCY)
+    last_offset = None
+
+    async def fetch_page(offset):
+        nonlocal last_offset
+        async with semaphore:
+            if last_offset is not None and offset > last_offset:
+                return None
+            page = await fetch_feed_page(feed_url, offset)
+        if page is None or len(page) < KEMONO_PAGE_SIZE:
+            last_offset = offset if last_offset is None else min(last_offset, offset)
+        return page
+
+    pages = []
+    for offset, page in zip(offsets, await asyncio.gather(*(fetch_page(offset) for offset in offsets))):
+        if page is None:
+            break
+        pages.append((offset, page))
+        if len(page) < KEMONO_PAGE_SIZE:
+            break
+    return pages
+
+# Fetch chapters newest first, served from the local post index
+async def fetch_chapters(feed_url, max_chapters, offset=0):
+    if max_chapters < 1:
+        raise ValueError("Number of chapters must be at least 1.")
+    creator_key = parse_feed_url(feed_url)
+    if creator_key:
+        return await post_index.get_posts(feed_url, *creator_key, max_chapters, offset)
+    pages = await fetch_feed_pages(feed_url, offset, max_chapters)
+    chapters = [post for page_offset, page in pages for post in page][offset % KEMONO_PAGE_SIZE:]
+    return sorted(chapters[:max_chapters], key=lambda x: x.get('published', ''), reverse=True)
+
+# Fetch chapter summaries (no post content) newest first, for the chapter selection view
+async def fetch_chapter_summaries(feed_url, max_chapters, offset=0):
+    if max_chapters < 1:
+        raise ValueError("Number of chapters must be at least 1.")
+    creator_key = parse_feed_url(feed_url)
+    if creator_key:
+        return await post_index.get_summaries(feed_url, *creator_key, max_chapters, offset)
+    return [ChapterSummary.from_post(post) for post in await fetch_chapters(feed_url, max_chapters, offset)]
+
+# Fetch a single post from Kemono API, or None on failure
+async def fetch_post(feed_url, post_id):
+    resp = await http_client.get(f"{feed_url.split('?')[0].rstrip('/')}/post/{post_id}")
+    if resp.status != 200:
+        logging.error(f"Failed to fetch post {post_id}: {resp.status}")
+        return None
+    data = resp.json()
+    if isinstance(data, list):
+        return data[0] if data else None
+    return data.get('post', data)
+
+# Load full posts for the given chapter summaries, from the post index where possible, keeping their order
+async def load_chapters(feed_url, summaries):
+    post_ids = [summary.id for summary in summaries]
+    creator_key = parse_feed_url(feed_url)
+    posts = await post_index.get_by_id(*creator_key, post_ids) if creator_key else {}
+    missing = [post_id for post_id in post_ids if post_id not in posts]
+    for post in await asyncio.gather(*(fetch_post(feed_url, post_id) for post_id in missing)):
+        if post:
+            posts[str(post['id'])] = post
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+# Download a single image, returning (media_type, content) or None
+async def fetch_image(path):
+    full_url = KEMONO_DATA_URL + path
+    resp = await http_client.get(full_url)
+    if resp.status != 200:
+        logging.error(f"Failed to download image {full_url}: HTTP {resp.status}")
+        return None
+    return resp.headers.get('Content-Type', 'image/jpeg'), resp.body
+
+# Write bytes to a file (run in a worker thread)
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# EPUB item whose content stays on disk until the book is written, so a build holds one image in memory at a time
+class SpooledEpubItem(epub.EpubItem):
+    def __init__(self, content_path, **kwargs):
+        super().__init__(**kwargs)
+        self.content_path = content_path
+
+    def get_content(self, default=b''):
+        with open(self.content_path, 'rb') as f:
+            return f.read()
+
+# Tags dropped together with their content, and void tags that are written self-closed
+DROPPED_TAGS = {'script', 'style', 'iframe', 'object', 'noscript', 'form', 'button', 'select', 'textarea', 'template'}
+VOID_TAGS = {'area', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+UNSAFE_VOID_TAGS = {'embed', 'input', 'link', 'meta', 'param'}
+# Block tags that implicitly end an open <p>, as they would in a browser
+BLOCK_TAGS = {'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4',
+              'h5', 'h6', 'header', 'hr', 'ol', 'p', 'pre', 'section', 'table', 'ul'}
+# Tags that implicitly end an open sibling, as they would in a browser: tag -> (tags it ends, tags that stop
+# the search for one)
+TABLE_SECTIONS = {'thead', 'tbody', 'tfoot'}
+IMPLICIT_END_TAGS = {
+    'li': ({'li'}, {'ul', 'ol', 'menu'}),
+    'dt': ({'dt', 'dd'}, {'dl'}),
+    'dd': ({'dt', 'dd'}, {'dl'}),
+    'tr': ({'tr'}, {'table'} | TABLE_SECTIONS),
+    'td': ({'td', 'th'}, {'tr', 'table'}),
+    'th': ({'td', 'th'}, {'tr', 'table'}),
+    'option': ({'option'}, {'select', 'datalist', 'optgroup'}),
+    **{section: (TABLE_SECTIONS, {'table'}) for section in TABLE_SECTIONS},
+}
+# Tags with other names (namespaced or custom elements) are dropped, keeping their content
+TAG_NAME = re.compile(r'[a-z][a-z0-9]*')
+ATTRIBUTE_NAME = re.compile(r'[A-Za-z_][\w.-]*')
+
+# Single-pass chapter HTML transformer. Tokenizes post HTML once and writes well-formed XHTML: scripts,
+# comments and event handlers are dropped, text and attributes are escaped and unclosed tags are closed.
+# Kemono image paths are collected in order and handed to on_image as soon as they are seen; their final
+# src is filled in by render() once the image has been downloaded.
+class ChapterHtml(HTMLParser):
+    def __init__(self, on_image=None):
+        super().__init__(convert_charrefs=True)
+        self.on_image = on_image
+        self.parts = []
+        self.images = []
+        self._seen = set()
+        self._open = []
+        self._skip = []
+
+    @classmethod
+    def transform(cls, content, on_image=None):
+        transformer = cls(on_image)
+        transformer.feed(content)
+        transformer.close()
+        return transformer
+
+    # Map a src attribute to a path on the Kemono data host, or None for images hosted elsewhere
+    @staticmethod
+    def image_path(src):
+        if src.startswith(KEMONO_DATA_URL + '/'):
+            return src[len(KEMONO_DATA_URL):]
+        if src.startswith('/') and not src.startswith('//'):
+            return src
+        return None
+
+    def _attributes(self, attrs):
+        seen = set()
+        out = []
+        for name, value in attrs:
+            if not ATTRIBUTE_NAME.fullmatch(name) or name.startswith('on') or name in seen:
+                continue
+            seen.add(name)
+            value = value or ''
+            if name in ('href', 'src') and value.strip().lower().startswith('javascript:'):
+                continue
+            out.append((name, value))
+        return out
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip:
+            if tag == self._skip[-1]:
+                self._skip.append(tag)
+            return
+        if tag in DROPPED_TAGS:
+            self._skip.append(tag)
+            return
+        if tag in UNSAFE_VOID_TAGS or not TAG_NAME.fullmatch(tag):
+            return
+        if tag in BLOCK_TAGS and self._open and self._open[-1] == 'p':
+            self._close_until('p')
+        if tag in IMPLICIT_END_TAGS:
+            self._end_sibling(*IMPLICIT_END_TAGS[tag])
+        attrs = self._attributes(attrs)
+        if tag == 'img':
+            self._image(attrs)
+            return
+        rendered = ''.join(f' {name}="{html.escape(value)}"' for name, value in attrs)
+        if tag in VOID_TAGS:
+            self.parts.append(f"<{tag}{rendered}/>")
+        else:
+            self.parts.append(f"<{tag}{rendered}>")
+            self._open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def _image(self, attrs):
+        attrs = dict(attrs)
+        src = attrs.pop('src', '')
+        attrs.setdefault('alt', '')
+        rendered = ''.join(f' {name}="{html.escape(value)}"' for name, value in attrs.items())
+        path = self.image_path(src)
+        if path is None:
+            self.parts.append(f'<img src="{html.escape(src)}"{rendered}/>')
+            return
+        if path not in self._seen:
+            self._seen.add(path)
+            self.images.append(path)
+            if self.on_image:
+                self.on_image(path)
+        self.parts.append((path, rendered))
+
+    def handle_endtag(self, tag):
+        if self._skip:
+            if tag == self._skip[-1]:
+                self._skip.pop()
+            return
+        if tag in self._open:
+            self._close_until(tag)
+
+    # Close the innermost open tag among ends, unless a boundary tag is open inside it
+    def _end_sibling(self, ends, boundaries):
+        for open_tag in reversed(self._open):
+            if open_tag in ends:
+                self._close_until(open_tag)
+                return
+            if open_tag in boundaries:
+                return
+
+    def _close_until(self, tag):
+        while self._open:
+            open_tag = self._open.pop()
+            self.parts.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(html.escape(data, quote=False))
+
+    def close(self):
+        super().close()
+        self._skip.clear()
+        while self._open:
+            self.parts.append(f"</{self._open.pop()}>")
+
+    # Approximate size of the markup, excluding image tags
+    @property
+    def text_size(self):
+        return sum(len(part) for part in self.parts if isinstance(part, str))
+
+    # Join the transformed markup; resolve(path) gives the src for each collected image
+    def render(self, resolve):
+        return ''.join(part if isinstance(part, str) else f'<img src="{html.escape(resolve(part[0]))}"{part[1]}/>'
+                       for part in self.parts)
+
+# Downloads images into spool_dir as their paths are added, with bounded concurrency; failures are logged and
+# skipped. wait() returns {path: (media_type, spooled file path)} once every added image is done.
+class ImageDownloader:
+    def __init__(self, spool_dir, progress=None):
+        self.spool_dir = spool_dir
+        self.progress = progress
+        self.semaphore = asyncio.Semaphore(IMAGE_CONCURRENCY)
+        self.tasks = {}
+        self.images = {}
+        self.done = 0
+        self.failed = 0
+
+    # Start downloading path unless it was already added
+    def add(self, path):
+        if path not in self.tasks:
+            self.tasks[path] = asyncio.create_task(self._download(len(self.tasks) + 1, path))
+
+    async def _download(self, index, path):
+        try:
+            async with self.semaphore:
+                entry = await image_cache.fetch(path, lambda: fetch_image(path))
+            if entry is not None:
+                media_type, content = entry
+                spool_path = os.path.join(self.spool_dir, str(index))
+                await asyncio.to_thread(write_file, spool_path, content)
+                self.images[path] = (media_type, spool_path)
+        except Exception as e:
+            logging.error(f"Failed to download image {KEMONO_DATA_URL + path}: {e}")
+        self.done += 1
+        if path not in self.images:
+            self.failed += 1
+        if self.progress:
+            await self.progress(self.done, len(self.tasks), self.failed)
+
+    async def wait(self):
+        await asyncio.gather(*self.tasks.values())
+        return self.images
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+# Downscale and re-encode one spooled image in place (runs in a worker process); returns its new media type.
+# The original is kept when Pillow can't read it, it is animated, or re-encoding doesn't make it smaller.
+def transcode_image(path, media_type, max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY):
+    buffer = io.BytesIO()
+    try:
+        with Image.open(path) as image:
+            if getattr(image, 'is_animated', False):
+                return media_type
+            image.thumbnail((max_dimension, max_dimension))
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                image.save(buffer, 'PNG', optimize=True)
+                new_type = 'image/png'
+            else:
+                image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True)
+                new_type = 'image/jpeg'
+    except Exception:
+        return media_type
+    if buffer.tell() >= os.path.getsize(path):
+        return media_type
+    write_file(path, buffer.getvalue())
+    return new_type
+
+image_pool = None
+
+# Process pool for image transcoding, started on first use
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return image_pool
+
+# Transcode all spooled images in the process pool, returning images with updated media types
+async def transcode_images(images):
+    loop = asyncio.get_running_loop()
+    pool = get_image_pool()
+    paths = list(images)
+    media_types = await asyncio.gather(*(
+        loop.run_in_executor(pool, transcode_image, images[path][1], images[path][0]) for path in paths
+    ))
+    return {path: (media_type, images[path][1]) for path, media_type in zip(paths, media_types)}
+
+# Serialize a book to EPUB bytes (run in a worker thread)
+def write_epub_bytes(book):
+    buffer = io.BytesIO()
+    if not epub.write_epub(buffer, book, {'raise_exceptions': True}):
+        raise IOError("Failed to write EPUB")
+    return buffer.getvalue()
+
+# Group consecutive chapter indices into volumes whose estimated size fits the budget. Text is assumed to
+# compress to about half its size; an image counts towards every volume that references it.
+def plan_volumes(text_sizes, chapter_images, image_sizes, size_budget):
+    volumes, current, current_images, current_size = [], [], set(), 0
+    for i, text_size in enumerate(text_sizes):
+        new_images = chapter_images[i] - current_images
+        size = text_size // 2 + sum(image_sizes[path] for path in new_images)
+        if current and current_size + size > size_budget:
+            volumes.append(current)
+            current, current_images, current_size = [], set(), 0
+            size = text_size // 2 + sum(image_sizes[path] for path in chapter_images[i])
+        current.append(i)
+        current_images |= chapter_images[i]
+        current_size += size
+    if current:
+        volumes.append(current)
+    return volumes
+
+# Create EPUB volumes from chapters, returning the contents of each file. Everything fits in one volume
+# unless the book exceeds size_budget even after image transcoding.
+async def create_epub(chapters, title, author, profile_url, progress=None, size_budget=EPUB_SIZE_BUDGET):
+    chapters = sorted(chapters, key=lambda x: x['published'])
+
+    spool = tempfile.TemporaryDirectory(prefix='epub-')
+    downloader = ImageDownloader(spool.name, progress)
+    try:
+        # Transform each chapter in one pass; images start downloading as soon as the transformer finds them,
+        # and every image is fetched once even if several chapters use it
+        with metrics.timer('images'):
+            pages = []
+            for chapter in chapters:
+                pages.append(ChapterHtml.transform(chapter.get('content') or '', downloader.add))
+                await asyncio.sleep(0)
+            images = await downloader.wait()
+        image_paths = {path: index for index, path in enumerate(downloader.tasks, 1)}
+        image_sizes = await asyncio.to_thread(lambda: {path: os.path.getsize(images[path][1]) for path in images})
+        metrics.count('image_bytes', sum(image_sizes.values()))
+        text_sizes = [page.text_size + len(chapter['title']) for chapter, page in zip(chapters, pages)]
+        retyped = set()
+        if IMAGE_TRANSCODE and Image is not None and sum(image_sizes.values()) + sum(text_sizes) // 2 > size_budget:
+            with metrics.timer('transcode'):
+                transcoded = await transcode_images(images)
+            retyped = {path for path in images if transcoded[path][0] != images[path][0]}
+            images = transcoded
+            image_sizes = await asyncio.to_thread(lambda: {path: os.path.getsize(images[path][1]) for path in images})
+
+        image_files = {}
+        for path, index in image_paths.items():
+            if path not in images:
+                continue
+            image_name = path.split('/')[-1]
+            if path in retyped:
+                image_name = os.path.splitext(image_name)[0] + (mimetypes.guess_extension(images[path][0]) or '')
+            if f"images/{image_name}" in image_files.values():
+                image_name = f"{index}_{image_name}"
+            image_files[path] = f"images/{image_name}"
+
+        # Images that failed to download keep pointing at Kemono
+        def resolve(path):
+            return image_files.get(path, KEMONO_DATA_URL + path)
+
+        contents = [f"<h1>{html.escape(chapter['title'])}</h1>\n{page.render(resolve)}"
+                    for chapter, page in zip(chapters, pages)]
+        chapter_images = [{path for path in page.images if path in images} for page in pages]
+        del pages
+
+        # Write the planned volumes one by one; a volume that still comes out too large is split in half
+        pending = deque(plan_volumes(text_sizes, chapter_images, image_sizes, size_budget))
+        numbered = len(pending) > 1
+        volumes = []
+        while pending:
+            volume = pending.popleft()
+            book = epub.EpubBook()
+            book.set_language("en")
+            book.set_title(f"{title} (Vol. {len(volumes) + 1})" if numbered else title)
+            book.add_author(author)
+            for path in sorted(set().union(*(chapter_images[i] for i in volume)), key=image_paths.get):
+                book.add_item(SpooledEpubItem(images[path][1], uid=f"img{image_paths[path]}",
+                                              file_name=image_files[path], media_type=images[path][0]))
+            epub_chapters = []
+            for i in volume:
+                chapter_epub = epub.EpubHtml(title=chapters[i]['title'], file_name=f'chap_{i + 1:02}.xhtml', lang='en')
+                chapter_epub.content = contents[i]
+                epub_chapters.append(chapter_epub)
+                book.add_item(chapter_epub)
+            book.toc = tuple(epub_chapters)
+            book.add_item(epub.EpubNcx())
+            book.add_item(epub.EpubNav())
+            book.spine = ['nav'] + epub_chapters
+            with metrics.timer('epub_write'):
+                data = await asyncio.to_thread(write_epub_bytes, book)
+            metrics.count('epub_bytes', len(data))
+            if len(data) > size_budget and len(volume) > 1:
+                half = len(volume) // 2
+                pending.extendleft([volume[half:], volume[:half]])
+                numbered = True
+                continue
+            volumes.append(data)
+        if len(volumes) > 1:
+            logging.info(f"Split '{title}' into {len(volumes)} volumes to fit {size_budget} bytes")
+        return volumes
+    finally:
+        downloader.cancel()
+        await asyncio.to_thread(spool.cleanup)
+
+# Sanitize filename
+def sanitize_filename(filename):
+    return re.sub(r'[^\w\s-]', '', filename).strip() or "untitled"
+
+# Generate filename from chapters
+def generate_filename(chapters):
+    if not chapters:
+        return "empty_chapters"
+    lowermost = chapters[-1].get('title', 'untitled')
+    uppermost = chapters[0].get('title', 'untitled')
+    return f"{sanitize_filename(lowermost[:15])}-{sanitize_filename(uppermost[:15])}" if len(chapters) > 1 else sanitize_filename(uppermost)
+
+# Release the shared HTTP client and image process pool
+async def shutdown():
+    global image_pool
+    await http_client.close()
+    if image_pool is not None:
+        image_pool.shutdown(wait=False, cancel_futures=True)
+        image_pool = None
+
+# Resolve a creators.txt name or a Kemono/Patreon URL to (display name, feed URL); the feed URL is None if invalid
+async def resolve_creator(creator):
+    url = creator_registry.get(creator)
+    name = creator if url is not None else None
+    feed_url = await fix_link(url if url is not None else creator)
+    if feed_url and name is None:
+        creator_key = parse_feed_url(feed_url)
+        name = await get_creator_name(*creator_key) if creator_key else "Unknown"
+    return name or creator, feed_url
+
+# Build the EPUB for one creator's newest max_chapters posts into output_dir; returns the written file paths
+async def export_creator(creator, output_dir, max_chapters=BATCH_MAX_CHAPTERS):
+    name, feed_url = await resolve_creator(creator)
+    if not feed_url:
+        raise ValueError(f"Invalid URL or creator name not found: {creator}")
+    chapters = await fetch_chapters(feed_url, max_chapters)
+    if not chapters:
+        return []
+    volumes = await create_epub(chapters, name, name, feed_url)
+    # The service and creator id keep files apart when two creators' names sanitize to the same string
+    creator_key = parse_feed_url(feed_url)
+    suffix = '-'.join(creator_key) if creator_key else hashlib.sha256(feed_url.encode()).hexdigest()[:12]
+    filename = f"{sanitize_filename(name)} ({sanitize_filename(suffix)})"
+    paths = []
+    for number, data in enumerate(volumes, start=1):
+        path = os.path.join(output_dir, f"{filename} Vol {number}.epub" if len(volumes) > 1 else f"{filename}.epub")
+        await asyncio.to_thread(write_file, path, data)
+        paths.append(path)
+    logging.info(f"Exported {len(chapters)} chapters of '{name}' to {', '.join(paths)}")
+    return paths
+
+# Export several creators concurrently over the shared connection pool, post index and image cache.
+# Returns {creator: file paths, or the exception that stopped its export}.
+async def export_creators(creators, output_dir, max_chapters=BATCH_MAX_CHAPTERS, concurrency=BATCH_CONCURRENCY):
+    os.makedirs(output_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def export(creator):
+        async with semaphore:
+            try:
+                with metrics.timer('export'):
+                    return await export_creator(creator, output_dir, max_chapters)
+            except Exception as e:
+                logging.error(f"Export of '{creator}' failed: {e}")
+                return e
+
+    try:
+        results = await asyncio.gather(*(export(creator) for creator in creators))
+    finally:
+        await shutdown()
+    return dict(zip(creators, results))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kemono webnovel EPUB tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    batch = commands.add_parser('batch', help="build EPUBs for several creators without Discord")
+    batch.add_argument('creators', nargs='*', help="creator names from creators.txt or Kemono/Patreon URLs (default: every entry in creators.txt)")
+    batch.add_argument('--output', '-o', default='epubs', help="directory the EPUB files are written to")
+    batch.add_argument('--chapters', '-n', type=int, default=BATCH_MAX_CHAPTERS, help="newest chapters to include per creator")
+    batch.add_argument('--concurrency', '-j', type=int, default=BATCH_CONCURRENCY, help="creators built at the same time")
+    args = parser.parse_args(argv)
+    if args.chapters < 1:
+        parser.error("--chapters must be at least 1")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    creators = args.creators or [name for name, _ in creator_registry.items()]
+    if not creators:
+        parser.error(f"no creators given and {CREATORS_FILE} is empty")
+    results = asyncio.run(export_creators(creators, args.output, args.chapters, args.concurrency))
+    for creator, result in results.items():
+        if isinstance(result, Exception):
+            print(f"{creator}: failed ({result})")
+        elif not result:
+            print(f"{creator}: no chapters found")
+        else:
+            print(f"{creator}: {', '.join(result)}")
+    return 1 if any(isinstance(result, Exception) for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())